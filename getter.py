@@ -1,5 +1,96 @@
+import gc
+import io
+import re
+import sys
+import json
+import pickle
+import codecs
+import array
+import keyword
+import itertools
+import timeit
+import types
+import weakref
 import unittest
-from operator import getitem, setitem, delitem
+from operator import setitem, delitem, itemgetter, attrgetter
+from collections.abc import Sequence
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def _key(value):
+    """Return a key for value that also tells apart equal values of different types, like 1, 1.0 and True."""
+    if type(value) is tuple:
+        return tuple, *map(_key, value)
+    if type(value) is dict:
+        return dict, *((k, _key(v)) for k, v in value.items())
+    if type(value) is slice:
+        return slice, _key(value.start), _key(value.stop), _key(value.step)
+    return type(value), value
+
+
+class _Handle:
+    """Stands in for a lens in the intern tables, since tuples can't be weakly referenced."""
+    __slots__ = 'lens', '__weakref__'
+
+    def __init__(self, lens):
+        self.lens = lens
+
+
+_nothing = {}
+# slices of ints and Nones, which are keyed by their fields as they are
+_simple_slice = lambda i: type(i.start) in _ints and type(i.stop) in _ints and type(i.step) in _ints
+_ints = int, type(None)
+# the number of lenses kept alive while unused, the most recently kept, see Lens
+KEEP_LENSES = 4096
+# the kept lenses in the order they were kept, by id, with their prefix and key among its children
+_kept = {}
+_identifier = lambda name: name.isidentifier() and not keyword.iskeyword(name)
+
+
+class _Source:
+    """Generates the source of a compiled lens function, holding the constants it refers to."""
+
+    def __init__(self, lens):
+        self.lens, self.names = lens, {'setitem': setitem, 'delitem': delitem}
+
+    def constant(self, value):
+        name = f'k{len(self.names)}'
+        self.names[name] = value
+        return name
+
+    def step(self, expr, f, i):
+        """Render one step applied to expr."""
+        if f == 0:
+            args, kwargs = i
+            args = [*map(self.constant, args)]
+            if all(map(_identifier, kwargs)):
+                args += [f'{k}={self.constant(v)}' for k, v in kwargs.items()]
+            else:
+                args.append(f'**{self.constant(kwargs)}')
+            return f"{expr}({', '.join(args)})"
+        if f == 1:
+            return f'{expr}.{i[0]}' if _identifier(i[0]) else f'getattr({expr}, {self.constant(i[0])})'
+        return f'{expr}[{self.constant(i[0])}]'
+
+    def path(self, steps):
+        """Render steps applied to obj, returning the expression and a comprehension loop for each hammer."""
+        expr, loops = 'obj', []
+        for f, *i in steps:
+            if f < 0:
+                loops.append(f'for o{len(loops) + 1} in {expr}')
+                expr = f'o{len(loops)}'
+            else:
+                expr = self.step(expr, f, i)
+        return expr, loops
+
+    def define(self, body, *args):
+        source = f"def lens({', '.join(('obj', *args))}):\n    {body}\n"
+        exec(compile(source, f'<{self.lens!r}>', 'exec'), self.names)
+        return self.names.pop('lens')
 
 
 class Lens(tuple):
@@ -11,75 +102,212 @@ class Lens(tuple):
     X._('bar')(foo) # return foo('bar')
     X[:].bar[3](foo) # return [i.bar[3] for i in foo]
 
+    On first use, each lens compiles itself into a function doing just its steps, e.g. X[:].bar[3] into
+    `lambda obj: [o1.bar[3] for o1 in obj]`, and keeps it for getting, setting and deleting respectively.
+
+    Lenses are interned: each keeps weak references to its extensions by step, so equal lenses are the same object
+    and share what they compiled, and rebuilding a lens in a loop only looks up each step. The KEEP_LENSES most
+    recently looked up through a weak reference or built are also kept alive by their prefix, attribute steps as
+    plain attributes so X.a.b is as cheap as any attribute lookup; the rest are dropped when nothing else uses them.
+    A lens keeps its prefix alive. Steps with unhashable arguments, like X[[1, 2]], make new lenses. Unpickling a
+    lens interns it again.
     """
     __delete = object()
-    __op = (
-        lambda f, a, k: f(*a, **k),
-        getattr, getitem,
-        setattr, setitem,
-        delattr, delitem,
-    )
     __fmt = (
         lambda a, kw: f'._({", ".join((*map(repr, a), *(f"{k}={v!r}" for k, v in kw.items())))})',
         ".{}".format,
         lambda x: f'[{x!r}]',
+        lambda: '[:]',  # hammers are -1
     )
-
-    def __call__(self, obj, *value):
-        if not self:
-            return obj
-
-        # the last action requires some pre-processing, so split that off
-        *t, (f, *i) = self
-
-        # drop trailing hammers
-        while f < 0 and t:
-            *t, (f, *i) = t
-
-        # if we still don't have a valid end function, then it was hammers all the way through
+    __roots = {}
+
+    def __new__(cls, steps=()):
+        lens = cls.__roots.get(cls)
+        if lens is None:
+            lens = cls.__roots[cls] = super().__new__(cls)
+        for step in steps:
+            step = tuple(step)
+            lens = lens.__extend(step, cls.__key(step))
+        return lens
+
+    @staticmethod
+    def __key(step):
+        """Return the key of step among the children of its prefix, None if it can't be hashed."""
+        f = step[0]
+        if f == 1:
+            return step[1]  # attribute names are always str, and keyed by themselves for __getattr__
         if f < 0:
-            return obj
+            return step
+        if f == 2 and type(step[1]) in (str, int):
+            return 2, type(step[1]), step[1]
+        if f == 2 and type(step[1]) is slice and _simple_slice(step[1]):
+            i = step[1]
+            return 2, slice, i.start, i.stop, i.step
+        if f == 0 and not step[2] and len(step[1]) < 2 and all(type(a) in (str, int) for a in step[1]):
+            # the common X.f() and X.f(key), see _
+            return 0, *map(type, step[1]), *step[1]
+        try:
+            key = (f, *map(_key, step[1:]))
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+    def __extend(self, step, key):
+        """Return this lens followed by step, the existing one if there is one."""
+        kept = self.__dict__.get('_Lens__kept')
+        if kept is None:
+            kept, children = self.__dict__['_Lens__kept'], self.__dict__['_Lens__children'] = {}, {}
+        else:
+            children = self.__dict__['_Lens__children']
+        lens = kept.get(key)
+        if lens is not None:
+            return lens
+        ref = children.get(key)
+        handle = ref and ref()
+        if handle is not None:
+            lens = handle.lens
+        else:
+            lens = super().__new__(type(self), (*self, step))
+            lens.__dict__['_Lens__parent'] = self
+            if key is None:
+                return lens
+            # the handle and the lens refer to each other, so the lens lives until the garbage collector finds
+            # neither is used anymore, then the handle's callback drops it from its prefix's children
+            handle = lens.__dict__['_Lens__handle'] = _Handle(lens)
+            children[key] = weakref.ref(handle, lambda ref: children.get(key) is ref and children.pop(key))
+        # keep it alive for a while, letting go of the longest kept lens past KEEP_LENSES
+        kept[key] = lens
+        _kept[id(lens)] = self, key
+        while len(_kept) > KEEP_LENSES:
+            prefix, old = _kept.pop(next(iter(_kept)))
+            dropped = prefix.__dict__['_Lens__kept'].pop(old)
+            if prefix.__dict__.get(old) is dropped:
+                del prefix.__dict__[old]
+        return lens
+
+    def __reduce__(self):
+        return type(self), (tuple(self),)
 
-        # if we're setting or deleting, adjust f
-        if value:
+    def __call__(self, obj, *value):
+        try:
+            if not value:
+                return self.__get(obj)
             if value[0] is self.__delete:
-                if not f:
-                    raise SyntaxError("can't delete function call")
-                f += 4
+                return self.__delete_(obj)
+            return self.__set(obj, value[0])
+        except AttributeError as e:
+            # compile on first use, the compiled functions are kept in the instance dict under their private names
+            if e.obj is not self or not e.name.startswith('_Lens__'):
+                raise
+        self.__compile()
+        return self(obj, *value)
+
+    def __compile(self):
+        """Generate the get, set and delete functions of this lens, and keep them."""
+        source = _Source(self)
+        # trailing hammers are dropped, and a lens of only hammers returns its argument
+        steps = list(self)
+        while steps and steps[-1][0] < 0:
+            steps.pop()
+        if not steps:
+            get = set_ = delete = lambda obj, *value: obj
+            self.__dict__.update(_Lens__get=get, _Lens__set=set_, _Lens__delete_=delete)
+            return
+
+        *path, (f, *i) = steps
+        expr, loops = source.path(path)
+
+        def mapped(body):
+            # each hammer maps the rest of the lens over the items, so nest a comprehension per hammer
+            for loop in reversed(loops):
+                body = f'[{body} {loop}]'
+            return f'return {body}'
+
+        get = source.define(mapped(source.step(expr, f, i)))
+        if not f:
+            def set_(obj, *value):
+                raise SyntaxError(f"can't {'assign to' if value else 'delete'} function call")
+            delete = set_
+        elif loops or not (f == 2 or _identifier(i[0])):
+            key = source.constant(i[0])
+            set_ = source.define(mapped(f"{('setattr', 'setitem')[f - 1]}({expr}, {key}, value)"), 'value')
+            delete = source.define(mapped(f"{('delattr', 'delitem')[f - 1]}({expr}, {key})"))
+        else:
+            set_ = source.define(f'{source.step(expr, f, i)} = value', 'value')
+            delete = source.define(f'del {source.step(expr, f, i)}')
+        self.__dict__.update(_Lens__get=get, _Lens__set=set_, _Lens__delete_=delete)
+
+    def __getter(self):
+        """Return the compiled get function of this lens."""
+        if '_Lens__get' not in self.__dict__:
+            self.__compile()
+        return self.__dict__['_Lens__get']
+
+    def __streamer(self, flat):
+        """Return the generator function of this lens, see stream, generating it on first use."""
+        name = ('_Lens__stream', '_Lens__flat')[flat]
+        function = self.__dict__.get(name)
+        if function is None:
+            source = _Source(self)
+            expr, loops = source.path(self)
+            if not loops:
+                body = f'iter(({expr},))'
+            elif flat:
+                body = f"({expr} {' '.join(loops)})"
             else:
-                if not f:
-                    raise SyntaxError("can't assign to function call")
-                f += 2
-                i += value
-
-        # apply the operation to obj in succession.
-        for p, (f_, *i_) in enumerate(t):
-            if f_ < 0:
-                # a hammer
-                tail_call = type(self)(tuple(self)[p + 1:])
-                return [tail_call(o, *value) for o in obj]
-            obj = self.__op[f_](obj, *i_)
-        return self.__op[f](obj, *i)
+                # each hammer yields a generator over the rest of the lens
+                body = expr
+                for loop in reversed(loops):
+                    body = f'({body} {loop})'
+            function = self.__dict__[name] = source.define(f'return {body}')
+        return function
 
     def __repr__(self):
         return f'{type(self).__name__}{"".join(self.__fmt[f](*i) for f, *i in self)}'
 
     # appending operators
     def _(self, *args, **kwargs):
-        return type(self)((*self, (0, args, kwargs)))
+        step = 0, args, kwargs
+        if kwargs or len(args) > 1 or args and type(args[0]) not in (str, int):
+            key = self.__key(step)
+        else:
+            key = (0, type(args[0]), args[0]) if args else (0,)  # as __key has it, without the call
+        return self.__dict__.get('_Lens__kept', _nothing).get(key) or self.__extend(step, key)
 
     def __getattr__(self, item):
-        return type(self)((*self, (1, item)))
+        if item.startswith('_Lens__'):
+            raise AttributeError(item, name=item, obj=self)  # a private cache that isn't filled yet
+        lens = self.__extend((1, item), item)
+        # kept lenses are attributes too, so looking them up again doesn't fail over to here
+        if self.__dict__['_Lens__kept'].get(item) is lens:
+            self.__dict__[item] = lens
+        return lens
 
     def __getitem__(self, item):
-        if item == slice(None):
-            # this is the map "hammer operator"
-            return type(self)((*self, (-1,)))
-
-        return type(self)((*self, (2, item)))
+        if type(item) in (str, int):
+            key = 2, type(item), item
+            step = 2, item
+        elif type(item) is slice and _simple_slice(item):
+            if item.start is item.stop is item.step is None:
+                # this is the map "hammer operator"
+                key = step = -1,
+            else:
+                key, step = (2, slice, item.start, item.stop, item.step), (2, item)
+        elif item == slice(None):
+            key = step = -1,
+        else:
+            step = 2, item
+            key = self.__key(step)
+        return self.__dict__.get('_Lens__kept', _nothing).get(key) or self.__extend(step, key)
 
     # descriptor methods
     def __get__(self, instance, owner):
+        try:
+            return self.__get(instance)
+        except AttributeError as e:
+            if e.obj is not self or not e.name.startswith('_Lens__'):
+                raise
         return self(instance)
 
     def __set__(self, instance, value):
@@ -90,6 +318,258 @@ class Lens(tuple):
 
 X = Lens()
 
+
+def stream(lens, obj, flat=False, chunk=None):
+    """
+    Apply a lens lazily, with each hammer yielding a generator instead of building a list.
+
+    Unlike calling the lens, trailing hammers iterate too, so stream(X[:], records) is an iterator over records.
+    With flat, the hammers chain into a single iterator, e.g. stream(X[:].items[:].price, orders, flat=True)
+    yields every price. With chunk, the outermost iterator is batched into lists of up to chunk items. Nothing is
+    evaluated ahead of what is consumed, so generators can be passed in and abandoning the result stops the work.
+    """
+    items = lens._Lens__streamer(flat)(obj)
+    if not chunk:
+        return items
+    return iter(lambda: list(itertools.islice(items, chunk)), [])
+
+
+class _JSONReader:
+    """Pulls a JSON text from a file a chunk at a time, keeping only what hasn't been consumed."""
+    whitespace = re.compile(r'[ \t\n\r]*')
+    string = re.compile(r'"(?:[^"\\]|\\.)*"', re.S)
+    scalar = re.compile(r'[^\s,\]}:]+')
+    # runs of anything but strings and brackets, strings, and brackets
+    structure = re.compile(r'[^"\[\]{}]+|"(?:[^"\\]|\\.)*"|[\[\]{}]', re.S)
+
+    def __init__(self, file, chunk):
+        self.read, self.chunk = file.read, chunk
+        self.decode = None
+        self.buffer, self.pos, self.offset, self.mark, self.eof = '', 0, 0, None, False
+
+    def fill(self):
+        """Read another chunk, returning False at the end of the file."""
+        data = self.read(self.chunk)
+        if isinstance(data, bytes):
+            if self.decode is None:
+                self.decode = codecs.getincrementaldecoder('utf-8')().decode
+            data = self.decode(data, not data)
+        if not data:
+            self.eof = True
+            return False
+        # drop what was consumed, unless a value is being captured
+        keep = self.pos if self.mark is None else self.mark
+        self.buffer = self.buffer[keep:] + data
+        self.offset, self.pos = self.offset + keep, self.pos - keep
+        if self.mark is not None:
+            self.mark -= keep
+        return True
+
+    def error(self, message):
+        return ValueError(f"{message} at offset {self.offset + self.pos}")
+
+    def peek(self):
+        """Skip whitespace and return the next character, or '' at the end."""
+        while True:
+            self.pos = self.whitespace.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self.fill():
+                return ''
+
+    def token(self, pattern):
+        """Consume and return a token, reading on while it may continue past the buffer."""
+        while True:
+            match = pattern.match(self.buffer, self.pos)
+            if match and (match.end() < len(self.buffer) or self.eof):
+                self.pos = match.end()
+                return match.group()
+            if not self.fill() and not match:
+                raise self.error("unterminated value")
+
+    def expect(self, character):
+        if self.peek() != character:
+            raise self.error(f"expected {character!r}")
+        self.pos += 1
+
+    def skip(self):
+        """Consume one value without decoding it."""
+        c = self.peek()
+        if c == '"':
+            return self.token(self.string)
+        if c not in '[{':
+            return self.token(self.scalar)
+        self.close(0)
+
+    def close(self, depth=1):
+        """Consume the rest of the array or object depth levels up."""
+        while True:
+            match = self.structure.match(self.buffer, self.pos)
+            if match is None:
+                if not self.fill():
+                    raise self.error("unterminated value")
+                continue
+            self.pos = match.end()
+            c = match.group()[0]
+            if c in '[{':
+                depth += 1
+            elif c in ']}':
+                depth -= 1
+                if not depth:
+                    return
+
+    def value(self):
+        """Consume and decode one value."""
+        self.peek()
+        self.mark = self.pos
+        try:
+            self.skip()
+            return json.loads(self.buffer[self.mark:self.pos])
+        finally:
+            self.mark = None
+
+    def items(self, close):
+        """Step through the elements of an array or the members of an object, stopping at each value."""
+        self.pos += 1
+        if self.peek() == close:
+            self.pos += 1
+            return
+        while True:
+            if close == '}':
+                if self.peek() != '"':
+                    raise self.error("expected a key")
+                key = self.token(self.string)
+                key = json.loads(key) if '\\' in key else key[1:-1]
+                self.expect(':')
+                yield key
+            else:
+                yield None
+            c = self.peek()
+            self.pos += 1
+            if c == close:
+                return
+            if c != ',':
+                self.pos -= 1
+                raise self.error(f"expected ',' or {close!r}")
+
+    def match(self, steps):
+        """Yield the values at the end of steps from the value about to be read, skipping what doesn't match."""
+        if not steps:
+            yield self.value()
+            return
+        (f, *i), rest = steps[0], steps[1:]
+        c = self.peek()
+        if c not in '[{' or f >= 0 and (c == '{') != isinstance(i[0], str):
+            self.skip()  # this value doesn't have the path
+            return
+        for n, key in enumerate(self.items(']' if c == '[' else '}')):
+            if f < 0:
+                yield from self.match(rest)
+            elif i[0] == (key if c == '{' else n):
+                yield from self.match(rest)
+                return self.close()  # only the first match of a key or index
+            else:
+                self.skip()
+
+
+def extract_json(file, lens, chunk=1 << 16):
+    """
+    Yield the values a lens finds in the JSON read from a file, without loading all of it.
+
+    Lenses may hold keys as attributes or items, array indexes, and hammers, which go through every element of an
+    array or every value of an object, e.g. extract_json(f, X['events'][:]['user']['id']). Values are read a chunk
+    at a time from a text or binary (utf-8) file, subtrees off the path are skipped without being decoded, and
+    values without the path are passed over. A key matches only the first member with it. A file of several
+    whitespace separated values, like JSON lines, is read value by value.
+    """
+    steps = tuple(lens)
+    for f, *i in steps:
+        if f == 0 or f > 0 and not (isinstance(i[0], str) or type(i[0]) is int and i[0] >= 0):
+            raise ValueError(f"can only extract keys, indexes and hammers from json, not {lens!r}")
+    reader = _JSONReader(file, chunk)
+
+    def values():
+        while reader.peek():
+            yield from reader.match(steps)
+
+    return values()
+
+
+_required = object()
+# rows transposed into columns at a time by pluck
+PLUCK_CHUNK = 4096
+
+
+def pluck(records, *lenses, typecode='d', default=_required, ndarray=False):
+    """
+    Apply each lens to every record in one pass, returning its results as an array.array of typecode.
+
+    With one lens its column is returned, with several a tuple of columns like itemgetter, and typecode may give
+    one typecode per lens. A leading hammer is optional: pluck(records, X[:]['price']) is pluck(records, X['price']).
+    With a default, records a lens can't be applied to, like those missing a key or attribute, give default. With
+    ndarray, columns are NumPy arrays over the arrays' memory.
+
+    Lenses of one item or of attributes only run as itemgetter or attrgetter, and others compile into one function.
+    """
+    if ndarray and numpy is None:
+        raise ImportError("pluck(..., ndarray=True) requires numpy")
+    paths = []
+    for lens in lenses:
+        steps = tuple(lens)  # indexing a lens would extend it
+        steps = steps[1:] if steps and steps[0][0] < 0 else steps
+        if not steps or any(f < 0 for f, *_ in steps):
+            raise ValueError(f"can only pluck a lens applied to each record, not {lens!r}")
+        paths.append(steps)
+    if len(typecode) not in (1, len(paths)):
+        raise ValueError(f"{len(paths)} lenses need 1 or {len(paths)} typecodes, not {typecode!r}")
+    typecodes = list(typecode * len(paths) if len(typecode) == 1 else typecode)
+    columns = None
+    if default is _required or isinstance(records, Sequence):
+        try:
+            columns = _columns(records, _getter(paths), typecodes)
+        except Exception:
+            if default is _required:
+                raise
+    if columns is None:
+        # apply each lens on its own, so a failing one only gives default for that value
+        gets = [Lens(path)._Lens__getter() for path in paths]
+
+        def get(record):
+            values = []
+            for get_ in gets:
+                try:
+                    values.append(get_(record))
+                except (LookupError, AttributeError, TypeError):
+                    values.append(default)
+            return values if len(values) > 1 else values[0]
+
+        columns = _columns(records, get, typecodes)
+    if ndarray:
+        columns = [numpy.frombuffer(column, column.typecode) for column in columns]
+    return columns[0] if len(columns) == 1 else tuple(columns)
+
+
+def _getter(paths):
+    """Return a function of a record giving the value of one path, or a tuple of the values of several."""
+    if all(len(path) == 1 and path[0][0] == 2 for path in paths):
+        return itemgetter(*(path[0][1] for path in paths))
+    if all(f == 1 and _identifier(name) for path in paths for f, name, *_ in path):
+        return attrgetter(*('.'.join(name for f, name in path) for path in paths))
+    source = _Source(Lens(paths[0]))
+    exprs = [source.path(path)[0] for path in paths]
+    return source.define(f"return {exprs[0] if len(exprs) == 1 else '(' + ', '.join(exprs) + ')'}")
+
+
+def _columns(records, get, typecodes):
+    if len(typecodes) == 1:
+        return [array.array(typecodes[0], list(map(get, records)))]  # arrays fill faster from a list
+    columns = [array.array(typecode) for typecode in typecodes]
+    rows = map(get, records)
+    for chunk in iter(lambda: list(itertools.islice(rows, PLUCK_CHUNK)), []):
+        for n, column in enumerate(columns):
+            column.fromlist(list(map(itemgetter(n), chunk)))
+    return columns
+
 getter =type("", (), {
     "__call__": lambda s, o:o,
     "__getattr__": lambda s, x: type("",(type(s),), {"__call__":lambda s,o:getattr(super(type(s),s).__call__(o), x)})(),
@@ -185,7 +665,209 @@ class TestLens(unittest.TestCase):
         c.first = 9
         self.assertEqual((9, *t[1:]), (c.first, c.second, c.third))
 
+    def test_compiled(self):
+        lens = X[:]['color']
+        self.assertEqual([x['color'] for x in self.json], lens(self.json))
+        self.assertIs(vars(lens)['_Lens__get'], vars(lens)['_Lens__get'])
+        self.assertEqual("Lens[:]['color']", repr(lens))
+
+        # set and delete through hammers
+        X[:]['seen'](self.json, True)
+        self.assertTrue(all(x['seen'] for x in self.json))
+        X[:]['seen'](self.json, Lens._Lens__delete)
+        self.assertFalse(any('seen' in x for x in self.json))
+        grid = [[[1], [2]], [[3]]]
+        self.assertEqual([[1, 2], [3]], X[:][:][0](grid))
+
+        # calls, keyword arguments and attributes that aren't identifiers
+        self.assertEqual(3, X.n._(n=3)(self.nonce))
+        self.assertEqual({'class': 1}, X._(**{'class': 1})(dict))
+        setattr(self.nonce, 'not an identifier', 1)
+        self.assertEqual(1, getattr(X, 'not an identifier')(self.nonce))
+        X.extra(self.nonce, 1)
+        X.extra(self.nonce, Lens._Lens__delete)
+        self.assertFalse(hasattr(self.nonce, 'extra'))
+        with self.assertRaises(SyntaxError):
+            X.n._(3)(self.nonce, 1)
+        with self.assertRaises(AttributeError):
+            X.missing(self.nonce)
+
+        # trailing hammers are dropped
+        self.assertIs(self.json, X[:](self.json))
+        self.assertIs(self.json, X(self.json, 1))
+
+
+    def test_interned(self):
+        self.assertIs(X.a[0]._(1, k=2)[:], X.a[0]._(1, k=2)[:])
+        self.assertIs(X.a[0], Lens(X.a[0]))
+        self.assertIs(X, Lens())
+        # equal steps of different types stay apart
+        self.assertIsNot(X[1], X[True])
+        self.assertIsNot(X[1:2], X[1.0:2])
+        # unhashable steps still work, they just aren't shared
+        self.assertEqual(X[[1]], X[[1]])
+        self.assertIsNot(X[[1]], X[[1]])
+
+        # compiled functions are shared
+        X['color']({}, 'red')
+        self.assertIn('_Lens__set', vars(X['color']))
+
+        # lenses are kept alive for a while, as attributes for attribute steps
+        lens = X['kept']
+        a = lens.a
+        self.assertIs(a, vars(lens)['a'])
+        self.assertIs(lens[0], vars(lens)['_Lens__kept'][2, int, 0])
+        # but only the most recently kept, the rest are weak references collected when they're unused
+        for i in range(1, KEEP_LENSES + 1):
+            lens[i]
+        self.assertEqual(KEEP_LENSES, len(_kept))
+        self.assertNotIn('a', vars(lens))
+        self.assertIs(a, lens.a)
+        self.assertIs(a, vars(lens)['a'])  # kept again
+        children = vars(lens)['_Lens__children']
+        self.assertNotIn((2, int, 0), vars(lens)['_Lens__kept'])
+        self.assertIn((2, int, 0), children)
+        gc.collect()
+        self.assertNotIn((2, int, 0), children)
+
+        # unpickled lenses are interned too
+        self.assertIs(X['a'].b[:]._(1, k=2), pickle.loads(pickle.dumps(X['a'].b[:]._(1, k=2))))
+
+    def test_stream(self):
+        orders = [{'items': [{'price': 1}, {'price': 2}]}, {'items': []}, {'items': [{'price': 3}]}]
+        nested = stream(X[:]['items'][:]['price'], orders)
+        self.assertIsInstance(nested, types.GeneratorType)
+        self.assertEqual([[1, 2], [], [3]], [list(prices) for prices in nested])
+        self.assertEqual([1, 2, 3], list(stream(X[:]['items'][:]['price'], orders, flat=True)))
+        self.assertEqual([[1, 2], [3]], list(stream(X[:]['items'][:]['price'], orders, flat=True, chunk=2)))
+        # trailing hammers iterate, and a lens without any streams its single value
+        self.assertEqual([{'price': 3}], list(stream(X[-1]['items'][:], orders)))
+        self.assertEqual([[]], list(stream(X[1]['items'], orders)))
+
+        # generators are consumed only as far as the results are
+        consumed = []
+
+        def records():
+            for n in itertools.count():
+                consumed.append(n)
+                yield {'id': n, 'tags': ['a', 'b']}
+
+        tags = stream(X[:]['tags'][:], records(), flat=True)
+        self.assertEqual(['a', 'b', 'a'], list(itertools.islice(tags, 3)))
+        self.assertEqual([0, 1], consumed)
+
+    def test_pluck(self):
+        records = [{'price': n / 2, 'qty': n, 'item': {'sku': n * 10}} for n in range(10)]
+        prices = pluck(records, X[:]['price'])
+        self.assertEqual(array.array('d', [r['price'] for r in records]), prices)
+        prices, qty, sku = pluck(records, X['price'], X['qty'], X['item']['sku'], typecode='dqq')
+        self.assertEqual([r['qty'] for r in records], qty.tolist())
+        self.assertEqual([r['item']['sku'] for r in records], sku.tolist())
+        self.assertEqual(5, len(pluck(iter(records[:5]), X['qty'], typecode='q')))
+
+        class Point:
+            def __init__(self, x, y):
+                self.x, self.y = x, y
+
+        xs, ys = pluck(map(Point, range(3), range(3, 6)), X.x, X.y, typecode='q')
+        self.assertEqual(([0, 1, 2], [3, 4, 5]), (xs.tolist(), ys.tolist()))
+
+        # missing values
+        records[3] = {'price': 1.5}
+        with self.assertRaises(KeyError):
+            pluck(records, X['item']['sku'])
+        sku = pluck(records, X['item']['sku'], typecode='q', default=-1)
+        self.assertEqual(-1, sku[3])
+        qty, sku = pluck(iter(records), X['qty'], X['item']['sku'], typecode='q', default=0)
+        self.assertEqual((0, 0, 40), (qty[3], sku[3], sku[4]))
+        with self.assertRaises(ValueError):
+            pluck(records, X['items'][:]['price'])
+        for typecode in 'dq', 'dqqq':
+            with self.assertRaises(ValueError):
+                pluck(records, X['price'], X['qty'], X['item'], typecode=typecode)
+
+    @unittest.skipIf(numpy is not None, "numpy is installed")
+    def test_pluck_ndarray_missing(self):
+        with self.assertRaises(ImportError):
+            pluck([{'price': 1}], X['price'], ndarray=True)
+
+    @unittest.skipIf(numpy is None, "requires numpy")
+    def test_pluck_ndarray(self):
+        prices = pluck([{'price': n} for n in range(5)], X['price'], ndarray=True)
+        self.assertEqual(10.0, prices.sum())
+
+    def test_extract_json(self):
+        document = {
+            "meta": {"note": "brackets ] } and \\\" quotes in strings", "events": "not these"},
+            "events": [
+                {"user": {"id": 1, "name": "\u00e9"}, "tags": ["a", {"b": [1, 2]}]},
+                {"kind": "no user"},
+                {"user": {"id": 2.5e3}, "tags": []},
+                {"user": [{"id": "in a list"}]},
+            ],
+            "counts": {"x": 1, "y": [True, False, None]},
+        }
+        text = json.dumps(document, indent=1)
+        for chunk in 1, 7, 1 << 16:
+            extract = lambda lens, text=text: list(extract_json(io.StringIO(text), lens, chunk))
+            self.assertEqual([1, 2500.0], extract(X['events'][:]['user']['id']))
+            self.assertEqual([1, 2500.0], extract(X.events[:].user.id))
+            self.assertEqual([document['events'][1]], extract(X['events'][1]))
+            self.assertEqual(["a", {"b": [1, 2]}], extract(X['events'][0]['tags'][:]))
+            self.assertEqual([1, [True, False, None]], extract(X['counts'][:]))
+            self.assertEqual([document], extract(X))
+            self.assertEqual([], extract(X['missing']['path']))
+            self.assertEqual([document['meta']['note']], extract(X['meta']['note']))
+        self.assertEqual(["\u00e9"], list(extract_json(io.BytesIO(text.encode()), X['events'][0]['user']['name'], 1)))
+
+        # json lines
+        lines = io.StringIO('{"id": 1}\n{"id": 2}\n[{"id": 3}]\n')
+        self.assertEqual([1, 2], list(extract_json(lines, X['id'])))
+
+        # results arrive before the rest is read
+        records = io.StringIO('[' + ', '.join(['{"id": 0}'] * 10000) + ']')
+        self.assertEqual([0, 0], list(itertools.islice(extract_json(records, X[:]['id'], 64), 2)))
+        self.assertLess(records.tell(), 1000)
+
+        with self.assertRaises(ValueError):
+            list(extract_json(io.StringIO('{"a": [1, 2}'), X['a'][:]))
+        with self.assertRaises(ValueError):
+            extract_json(io.StringIO('{}'), X.a._())
+
+
+def bench(number=1_000_000):
+    """Time compiled lenses against the same access written by hand."""
+    class Obj:
+        pass
+
+    obj = Obj()
+    obj.a = Obj()
+    obj.a.b = [1, 2, 3]
+    records = [{'price': n} for n in range(1000)]
+    get, prices = X.a.b[0], X[:]['price']
+
+    class Described(Obj):
+        first = X.a.b[0]
+
+    described = Described()
+    described.a = obj.a
+    for label, f, n in (
+        ('obj.a.b[0]', lambda: obj.a.b[0], number),
+        ('build X.a.b[0]', lambda: X.a.b[0], number),
+        ('X.a.b[0](obj)', lambda: get(obj), number),
+        ('X.a.b[0](obj), rebuilt', lambda: X.a.b[0](obj), number),
+        ('descriptor', lambda: described.first, number),
+        ("[r['price'] for r in records]", lambda: [r['price'] for r in records], number // 1000),
+        ("X[:]['price'](records)", lambda: prices(records), number // 1000),
+        ("array('d', [r['price'] for ...])", lambda: array.array('d', [r['price'] for r in records]), number // 1000),
+        ("pluck(records, X['price'])", lambda: pluck(records, X['price']), number // 1000),
+        ("pluck(records, X['price'] twice)", lambda: pluck(records, X['price'], X['price']), number // 1000),
+    ):
+        print(f'{label:>32}: {min(timeit.repeat(f, number=n, repeat=5)) / n * 1e9:10.1f}ns')
 
 
 if __name__ == '__main__':
-    unittest.main()
+    if sys.argv[1:] == ['bench']:
+        bench()
+    else:
+        unittest.main()
@@ -1,6 +1,10 @@
+import ast
 import unittest
-from functools import reduce as R
+from array import array
+from functools import reduce as R, lru_cache
 from roperator import *
+try:import numpy as np
+except ImportError:np=None
 
 """
 ** SHORTENINGS **
@@ -21,6 +25,22 @@ r: a record (tuple)
 ** FUNCTIONS **
 e(l, *a): evaluate a lambda with the given arguments
 a(l): determine the arrity of a lambda
+O(l): optimize a lambda for numbers: fold runs of int constants (x+1-3 is x-2) and drop identities (x*1, x+0)
+q(o): a hashable key of o, equal for equal lambdas
+Q(l): whether a lambda is pure enough to evaluate once for all its uses: it makes no calls
+H(l, h): count the subexpressions of a lambda into h
+n(l, g, h): the ast node of a lambda. Subexpressions counted more than once in h are evaluated once into a name
+p(l, g): the python source of a lambda, with constants that can't be literals put in g
+c(l, n=0): compile a lambda into a python function, kept on l. F uses these. n: it only sees numbers, so O it first
+A(o): o as a numpy array when it's a flat numeric buffer (array.array, memoryview), else o
+N(o): whether o is a flat numeric numpy array
+w(l): whether numpy can evaluate a lambda on a whole array at once
+Y(o): a numpy array as int64 or as it is, with the bounds of its values, see I
+I(l, b): the bounds of a lambda's values for x within bounds b: (lo, hi) for ints, 'b' for bools, 'f' for floats,
+    None where int64 could overflow, numpy would answer differently from python, or python refuses (bitwise floats)
+W(f, o, b): whether the ufunc f reduces o, with bounds b, to what python would
+u(l): the numpy ufunc whose reduce does F[l], if any
+S(o, r): run the F record r on o, vectorized when o is a numpy array and r allows it
 
 ** VALUES **
 x,y: stand-in variables for the first and second position
@@ -30,7 +50,193 @@ t,i=type,isinstance
 T=tuple,
 x=t("",T,{f'__{f.__name__}__':(lambda f:lambda s,*a,**k:t(s)((*s,(f,a,k))))(f)for f in(getitem,call,getattr,lt,le,eq,ne,ge,gt,add,radd,and_,rand,floordiv,rfloordiv,lshift,rlshift,matmul,rmatmul,mod,rmod,mul,rmul,or_,ror,pow,rpow,rshift,rrshift,sub,rsub,truediv,rtruediv,xor,rxor)})()
 y,a,e=t("",(t(x),),{})(),lambda l:i(l,t(y))or any(a(l)for r in l for l in r[1]if i(l,t(x))),lambda l,*a:R(lambda l,r:r[0](l,*(e(l,*a)if i(l,t(x))else l for l in r[1]),**r[2]),l,a[i(l,t(y))])
-F=t("",T,{"__call__":lambda s,l:t(s)((*s,(2,l)))if i(l,t(x))else R(lambda i,r:(filter,R,map)[r[0]](lambda*a:e(r[1],*a),i),s,l),"__getitem__":lambda s,l:t(s)((*s,(a(l),l)))})()
+
+# operators as syntax: binary operators, their reflections which swap the operands, and comparisons
+B={add:ast.Add,sub:ast.Sub,mul:ast.Mult,truediv:ast.Div,floordiv:ast.FloorDiv,mod:ast.Mod,pow:ast.Pow,lshift:ast.LShift,rshift:ast.RShift,and_:ast.BitAnd,or_:ast.BitOr,xor:ast.BitXor,matmul:ast.MatMult}
+G={radd:add,rsub:sub,rmul:mul,rtruediv:truediv,rfloordiv:floordiv,rmod:mod,rpow:pow,rlshift:lshift,rrshift:rshift,rand:and_,ror:or_,rxor:xor,rmatmul:matmul}
+B.update({r:(B[f],)for r,f in G.items()})
+C={lt:ast.Lt,le:ast.LtE,eq:ast.Eq,ne:ast.NotEq,ge:ast.GtE,gt:ast.Gt}
+
+
+# constants that can be literals; q keys them by value and everything else by identity
+L=int,float,complex,str,bytes,bool,t(None)
+# identities for numbers: x op Z[op], or Z[op] op x for the reflections, is x. D: the sign these ops add a constant with
+Z={add:0,radd:0,sub:0,mul:1,rmul:1,pow:1,or_:0,ror:0,xor:0,rxor:0,lshift:0,rshift:0}
+D={add:1,radd:1,sub:-1}
+
+
+def O(l):
+    r=[]
+    for f,a,k in l:
+        a=tuple(O(o)if i(o,t(x))else o for o in a)
+        if not k and len(a)==1 and t(a[0])is int:
+            v=a[0]
+            if r and not r[-1][2]and len(r[-1][1])==1 and t(r[-1][1][0])is int:
+                g,(b,),_=r[-1]
+                if f in D and g in D:r.pop();f,v=add,D[g]*b+D[f]*v
+                elif f in(mul,rmul)and g in(mul,rmul):r.pop();f,v=mul,b*v
+            if f is add and v<0:f,v=sub,-v
+            if Z.get(f)==v:continue
+            a=v,
+        r.append((f,a,k))
+    return t(l)(r)
+
+
+def q(o):
+    if i(o,t(x)):return t(o),tuple((f,tuple(map(q,a)),tuple((w,q(v))for w,v in k.items()))for f,a,k in o)
+    return(t(o),repr(o))if t(o)in L else id(o)
+
+
+def Q(l):
+    return all(f is not call and all(Q(o)for o in a if i(o,t(x)))for f,a,_ in l)
+
+
+def H(l,h):
+    k=q(l);h[k]=h.get(k,0)+1
+    if l and(h[k]<2 or not Q(l)):
+        *r,(f,a,kw)=l;H(t(l)(r),h)
+        for o in(*a,*kw.values()):
+            if i(o,t(x)):H(o,h)
+
+
+def n(l,g,h):
+    """the expression node of lambda l, in evaluation order so a subexpression counted twice in h is named where it's
+    first evaluated"""
+    def m(o):
+        if i(o,t(x)):return n(o,g,h)
+        # unparse doesn't bracket a negative constant, so (-2)**x would read as -(2**x)
+        if t(o)in(int,float)and repr(o)[0]=='-':return ast.UnaryOp(ast.USub(),ast.Constant(-o))
+        if t(o)in L and not(t(o)is complex and repr(o)[0]=='-'):return ast.Constant(o)
+        g[f'_{len(g)}']=o
+        return ast.Name(f'_{len(g)-1}',ast.Load())
+    k=q(l)
+    if i(h.get(k),str):return ast.Name(h[k],ast.Load())
+    if not l:return ast.Name('xy'[i(l,t(y))],ast.Load())
+    *r,(f,a,kw)=l;r=t(l)(r)
+    if f is getattr and t(a[0])is str and a[0].isidentifier():o=ast.Attribute(m(r),a[0],ast.Load())
+    elif i(B.get(f),T):a=m(a[0]);o=ast.BinOp(a,B[f][0](),m(r))
+    elif f is call or f in B or f in C or f is getitem:
+        o=m(r);a=[*map(m,a)]
+        if f in C:o=ast.Compare(o,[C[f]()],a)
+        elif f in B:o=ast.BinOp(o,B[f](),a[0])
+        elif f is getitem:o=ast.Subscript(o,a[0],ast.Load())
+        else:o=ast.Call(o,a,[ast.keyword(w,m(v))for w,v in kw.items()])
+    else:f=m(f);o=ast.Call(f,[m(r),*map(m,a)],[ast.keyword(w,m(v))for w,v in kw.items()])
+    if h.get(k,0)>1 and Q(l):
+        h[k]=f'_v{sum(i(v,str)for v in h.values())}'
+        o=ast.NamedExpr(ast.Name(h[k],ast.Store()),o)
+    return o
+
+
+def p(l,g):
+    h={};H(l,h)
+    return ast.unparse(ast.Lambda(ast.arguments([],[ast.arg(v)for v in'xy'[:1+a(l)]],None,[],[],None,[]),n(l,g,h)))
+
+
+@lru_cache(1024)
+def K(s):
+    """the code of a lambda's source, shared by equal lambdas"""
+    return compile(s,'<getter3>','eval')
+
+
+def c(l,n=0):
+    d,k=vars(l),f'<c{n}>'
+    if k not in d:g={};d[k]=eval(K(p(O(l)if n else l,g)),g)
+    return d[k]
+
+
+# reductions numpy does in one call. ufunc.reduce folds left like R, so y op x only when op commutes
+U={f:getattr(np,u)for f,u in((add,'add'),(sub,'subtract'),(mul,'multiply'),(truediv,'true_divide'),(floordiv,'floor_divide'),(mod,'remainder'),(pow,'power'),(lshift,'left_shift'),(rshift,'right_shift'),(and_,'bitwise_and'),(or_,'bitwise_or'),(xor,'bitwise_xor'))}if np else{}
+
+
+def A(o):
+    if np and i(o,(array,memoryview)):
+        v=np.asarray(o)
+        if N(v):return v
+    return o
+
+
+def N(o):
+    return np and i(o,np.ndarray)and o.ndim==1 and o.dtype.kind in'biufc'
+
+
+def w(l):
+    return all(f in B or f in C for f,_,_ in l)and all(w(o)if i(o,t(x))else t(o)in(int,float,complex,bool)for _,a,_ in l for o in a)
+
+
+# int64 bounds, and the ints a float64 holds exactly
+M,E=2**63-1,2**53
+
+
+def Y(o):
+    if o.dtype.kind in'fc':return o,'f'
+    b=(int(o.min()),int(o.max()))if len(o)else(0,0)
+    return(o.astype(np.int64,copy=False),b)if-M<=b[0]and b[1]<=M else(o,None)
+
+
+def I(l,v):
+    b=v
+    for f,a,_ in l:
+        o=a[0]
+        c=I(o,v)if i(o,t(x))else'b'if t(o)is bool else(o,o)if t(o)is int else'f'
+        if f in G:f,b,c=G[f],c,b
+        b=J(f,b,c)
+        if b is None:return None
+    return b
+
+
+def J(f,b,c):
+    """the bounds of f(p, q) for p within b and q within c"""
+    if None in(b,c):return None
+    if'f'in(b,c):return None if f in(and_,or_,xor,lshift,rshift)else'f'if all(o in('f','b')or-E<=o[0]and o[1]<=E for o in(b,c))else None
+    if f in C:return'b'
+    if'b'==b==c:return'b'if f in(and_,or_,xor)else None
+    b,c=[(0,1)if o=='b'else o for o in(b,c)]
+    if f in(and_,or_,xor):n=max(abs(o).bit_length()for o in b+c);return-2**n,2**n-1
+    if f is truediv:return'f'if-E<=min(b+c)and max(b+c)<=E else None
+    if f in(floordiv,mod)and c[0]<=0<=c[1]:return None
+    if f is mod:n=max(map(abs,c));z=1-n,n-1
+    elif f is pow and c[0]==c[1]>=0 and(c[0]<64 or max(map(abs,b))<2):z=b[0]**c[0],b[1]**c[0],0 if b[0]<0<b[1]else b[0]
+    elif f in(lshift,rshift)and 0<=c[0]and c[1]<64 or f in(add,sub,mul,floordiv):z=[f(p,q)for p in b for q in c]
+    else:return None
+    return(min(z),max(z))if-M<=min(z)and max(z)<=M else None
+
+
+def W(f,o,b):
+    if b=='f':return True
+    if b is None or f in(np.power,np.left_shift,np.right_shift):return False
+    # int64 + - * wrap around, so the answer is right whenever the true one fits
+    if f in(np.add,np.subtract):return np.abs(o.astype(float)).sum()<2**62
+    if f is np.multiply:return not o.all()or np.log2(np.abs(o.astype(float))).sum()<62
+    return f is not np.true_divide or-E<=b[0]and b[1]<=E
+
+
+def u(l):
+    if len(l)!=1:return None
+    (f,a,k),=l
+    if k or len(a)!=1 or t(a[0])not in(t(x),t(y))or a[0]or t(a[0])is t(l):return None
+    return U.get(f)if t(l)is t(x)or f in(add,mul,and_,or_,xor)else None
+
+
+def S(o,r):
+    k,l=r
+    if N(o):
+        o,b=Y(o)
+        try:
+            with np.errstate(all='raise'):
+                if k==1:
+                    f=u(l)
+                    if f and len(o)and W(f,o,b):return f.reduce(o)
+                elif not a(l)and w(l)and I(l,b)is not None:
+                    v=c(l,1)(o)
+                    return v if k else o[v.astype(bool)]
+        # numpy refuses or differs from python here (x/0, ...): python numbers decide
+        except(TypeError,ValueError,ArithmeticError):pass
+        o=o.tolist()
+    return(filter,R,map)[k](c(l),o)
+
+
+F=t("",T,{"__call__":lambda s,l:t(s)((*s,(2,l)))if i(l,t(x))else R(S,s,A(l)),"__getitem__":lambda s,l:t(s)((*s,(c(l).__code__.co_argcount-1,l)))})()
 
 
 class Test(unittest.TestCase):
@@ -63,6 +269,88 @@ class Test(unittest.TestCase):
             sum(range(10))
         )
 
+    def test_compile(self):
+        self.assertEqual('lambda x, y: x * y + 1', p(x*y+1, {}))
+        self.assertEqual('lambda x: 2 - (_v0 := x[0]) ** (-1) < _v0.real', p(2-x[0]**-1<x[0].real, {}))
+        g={}
+        self.assertEqual("lambda x: _0(x, 'a b') + x.split(x[0], sep=_1)", p(x.__getattr__('a b')+x.split(x[0],sep=[]), g))
+        self.assertEqual((getattr, []), (g['_0'], g['_1']))
+        for l,o in (x*y+1,(2,3)),(2-x[0]**-1<x[0].real,([4],)),(x['a']//3,({'a':10},)),(x.bit_length(),(7,)):
+            self.assertEqual(e(l,*o),c(l)(*o))
+        for l in(-2)**x,(-1.5)**x,(-0.0)**x+x,(-1j)**x,x-(-3):
+            self.assertEqual([e(l,i)for i in range(4)],self.call(l,range(4)))
+        self.assertEqual('lambda x: (-2) ** x', p((-2)**x, {}))
+        l=x+1
+        self.assertIs(c(l),c(l))
+        self.assertIs(c(l).__code__,c(x+1).__code__)
+        self.assertEqual([i+1 for i in range(10)],self.call(l,range(10)))
+        self.assertEqual(sum(range(10)),F[x+y](range(10)))
+
+    def test_optimize(self):
+        self.assertEqual('lambda x: x', p(O(x*1+0), {}))
+        self.assertEqual('lambda x: x - 1', p(O(x+1+2-4), {}))
+        self.assertEqual('lambda x: x * 6 + 1', p(O(2*x*3+1-0), {}))
+        self.assertEqual('lambda x, y: (_v0 := (x[0] + y)) * _v0', p(O((x[0]+y)*(x[0]+y)), {}))
+        self.assertEqual('lambda x: (_v1 := ((_v0 := x.a) + _v0)) * _v1 - _v0', p((x.a+x.a)*(x.a+x.a)-x.a, {}))
+        # calls aren't assumed to give the same answer twice, only the attribute fetch is shared
+        self.assertEqual('lambda x: (_v0 := x.f)() + _v0()', p(x.f()+x.f(), {}))
+        calls=[]
+        class Int(int):
+            def __getattribute__(s, f):
+                calls.append(f)
+                return Int(int.__getattribute__(s, f))
+            def __add__(s, o):
+                calls.append('+')
+                return Int(int(s)+o)
+            def __mul__(s, o):
+                calls.append('*')
+                return Int(int(s)*o)
+        def count(f, *a):
+            calls.clear()
+            return f(*a), len(calls)
+        for l,before,after,n in ((x.real+1)*(x.real+1),5,3,0),((x.real*2)*(3*x.real)+x.real,6,4,0),(x*1+0+2-1,3,1,1):
+            self.assertEqual((count(e,l,Int(5))[0],before),count(e,l,Int(5)))
+            self.assertEqual((count(e,l,Int(5))[0],after),count(c(l,n),Int(5)))
+        # identities only hold for numbers
+        self.assertRaises(TypeError,self.call,x+0,['a'])
+        self.assertIs(int,t(c(x*1)(True)))
+        self.assertEqual('lambda x: x', p(O(x*1+0), {}))
+
+    @unittest.skipIf(np is None, 'numpy is not installed')
+    def test_vectorized(self):
+        for o in np.arange(10),array('i',range(10)),memoryview(array('d',range(10))):
+            v=F(x*2+1)(o)
+            self.assertIsInstance(v,np.ndarray)
+            self.assertEqual([i*2+1 for i in range(10)],list(v))
+            self.assertEqual([i for i in range(10)if i>3],list(F[x>3](o)))
+            self.assertEqual(sum(range(10)),F[x+y](o))
+        o=np.arange(1,6)
+        self.assertIsInstance(F[x>3](o),np.ndarray)
+        self.assertEqual(R(sub,range(1,6)),F[x-y](o))
+        self.assertEqual(120,F[y*x](o))
+        self.assertEqual([5,6],list(F(x+1)[x>4](o)))
+        self.assertEqual(11,F(x+1)[x>4][x+y](o))
+        # not elementwise or not like python: the scalar path
+        self.assertIsInstance(F(x.real)(o),map)
+        self.assertEqual(R(lambda x,y:y-x,range(1,6)),F[y-x](o))
+        self.assertEqual([1/i for i in range(1,6)],list(F(x**-1)(o)))
+        self.assertRaises(ZeroDivisionError,list,F(1/x)(np.arange(3)))
+        self.assertRaises(TypeError,F[x+y],np.arange(0))
+        self.assertIsInstance(F(x+1)(np.arange(4).reshape(2,2)),map)
+        # ints numpy would wrap around are left to python
+        for l,o in (x*x,array('i',[100000])),(x+1,array('B',[255])),(2**x,np.arange(70)),(x<<60,np.arange(20)),\
+                   ((x>1)+(x>2),np.arange(4)),(x-1,array('Q',[0,2**64-1])),(x/3,np.array([2**60+1])):
+            self.assertEqual([e(l,i)for i in np.asarray(o).tolist()],list(F(l)(o)))
+        self.assertIsInstance(F(x*x-x)(array('i',[100000])),np.ndarray)
+        self.assertEqual(R(mul,range(1,30)),F[x*y](array('q',range(1,30))))
+        self.assertEqual(0,F[x*y](np.array([2**40,2**40,0])))
+        self.assertEqual(2**62,F[x+y](np.array([2**61,2**61])))
+        self.assertEqual(4,F[x+y](np.array([True,True,False,True,True])))
+        # bitwise identities only go for ints, floats refuse bitwise ops as in python
+        for l in x>>0,x<<0,x^0,0|x:
+            self.assertRaises(TypeError,list,F(l)(np.array([1.5,2.5])))
+            self.assertEqual([1,2],list(F(l)(np.array([1,2]))))
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,74 @@
+"""
+Rough benchmarks for the orm.
+
+    python -m orm.bench [name [rows]]
+
+Each benchmark builds its own model in a fresh in-memory database and prints timings.
+"""
+import os
+import sys
+import time
+import random
+import logging
+import tempfile
+from orm.orm import Model, Field, initialize_database
+
+random.seed(0)
+words = [''.join(random.choices('abcdefghijklmnopqrstuvwxyz', k=random.randint(3, 9))) for _ in range(20000)]
+
+
+def timed(label, f, repeat=5):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = f()
+        best = min(best, time.perf_counter() - start)
+    print(f'{label:>32}: {best * 1000:10.2f}ms')
+    return result
+
+
+def fulltext(rows=1_000_000):
+    """Full text MATCH through the fts5 index against a LIKE scan."""
+    class Document(Model):
+        title = Field(str, fulltext=True)
+
+    connect = initialize_database()
+    with connect() as conn:
+        timed(f'insert {rows} rows', lambda: conn.executemany(
+            "INSERT INTO document(title) VALUES (?)",
+            ((' '.join(random.choices(words, k=8)),) for _ in range(rows)),
+        ), repeat=1)
+    word = random.choice(words)
+    like = timed('LIKE', lambda: connect().execute(
+        "SELECT id FROM document WHERE title LIKE ?", (f'%{word}%',)
+    ).fetchall())
+    match = timed('MATCH', lambda: Document(title__match=word).all())
+    # LIKE also finds the word inside longer words
+    print(f'{"rows found":>32}: {len(like)} LIKE, {len(match)} MATCH')
+
+
+def compression(rows=2000):
+    """File size and read/write latency of large text with and without Field(compress=...)."""
+    class Plain(Model):
+        body = Field(str)
+
+    class Zlib(Model):
+        body = Field(str, compress='zlib')
+
+    class Lzma(Model):
+        body = Field(str, compress='lzma')
+
+    texts = [' '.join(random.choices(words, k=random.randint(200, 2000))) for _ in range(rows)]
+    with tempfile.TemporaryDirectory() as directory:
+        for model in Plain, Zlib, Lzma:
+            path = os.path.join(directory, f'{model}.db')
+            initialize_database(path)
+            timed(f'{model} write {rows} rows', lambda: [model.row(text).save() for text in texts], repeat=1)
+            timed(f'{model} read {rows} rows', model.all)
+            print(f'{f"{model} file size":>32}: {os.path.getsize(path) / 1024:10.0f}KiB')
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    name, *args = sys.argv[1:] or ['fulltext']
+    globals()[name](*map(int, args))